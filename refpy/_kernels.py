@@ -0,0 +1,61 @@
+"""
+Numeric kernels used by refpy.constraints.Inequality.
+
+If numba is available the kernels are compiled with @njit and cached
+on disk, so the compilation cost is only payed on the first run.
+Otherwise the vectorized numpy implementations are used, which keeps
+numba an optional dependency.
+"""
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+if njit is None:
+    def saturate(coeffs, degree):
+        np.minimum(coeffs, degree, out = coeffs)
+        return coeffs
+
+    def divide(coeffs, d):
+        # in place to avoid the temporaries of (coeffs + d - 1) // d
+        np.add(coeffs, d - 1, out = coeffs)
+        np.floor_divide(coeffs, d, out = coeffs)
+        return coeffs
+
+    def multiply(coeffs, f):
+        np.multiply(coeffs, f, out = coeffs)
+        return coeffs
+
+    def isContradiction(coeffs, degree):
+        return int(coeffs.sum()) < degree
+
+else:
+    @njit(cache = True)
+    def saturate(coeffs, degree):
+        for i in range(coeffs.shape[0]):
+            if coeffs[i] > degree:
+                coeffs[i] = degree
+        return coeffs
+
+    @njit(cache = True)
+    def divide(coeffs, d):
+        for i in range(coeffs.shape[0]):
+            coeffs[i] = (coeffs[i] + d - 1) // d
+        return coeffs
+
+    @njit(cache = True)
+    def multiply(coeffs, f):
+        for i in range(coeffs.shape[0]):
+            coeffs[i] = coeffs[i] * f
+        return coeffs
+
+    @njit(cache = True)
+    def isContradiction(coeffs, degree):
+        slack = -degree
+        for i in range(coeffs.shape[0]):
+            slack += coeffs[i]
+        return slack < 0
@@ -1,15 +1,38 @@
-from recordclass import structclass
+from collections import namedtuple
+
+import numpy as np
 import parsy
 
 def copysign(a, b):
-       if b >= 0:
-               return abs(a)
-       else:
-               return -abs(a)
+    # branchless: s is 0 or -1 depending on the sign of b, and
+    # (x ^ -1) - -1 is two's complement negation
+    s = -(b < 0)
+    return (abs(a) ^ s) - s
 
+from refpy import _kernels
 from refpy.parser import getOPBConstraintParser, getCNFConstraintParser
 
-Term = structclass("Term","coefficient variable")
+# only used as temporary representation, e.g. by the parsers; the
+# terms of an Inequality live in its coeffs / vars arrays
+Term = namedtuple("Term", "coefficient variable")
+
+# number of terms in the other constraint from which addWithFactor
+# switches from the dict based merge to the vectorized one
+BULK_MERGE_THRESHOLD = 128
+
+def mergeSignedTerms(absVars, signedCoeffs):
+    """
+    Merge signed coefficient contributions that share the same
+    variable in one vectorized pass. Returns the unique variables,
+    the merged signed coefficient per variable and the total
+    cancellation, i.e. for every variable how much of the positive
+    and negative contributions cancelled out.
+    """
+    uniqueVars, inverse = np.unique(absVars, return_inverse = True)
+    merged = np.zeros(len(uniqueVars), dtype = signedCoeffs.dtype)
+    np.add.at(merged, inverse, signedCoeffs)
+    cancellation = (int(np.abs(signedCoeffs).sum()) - int(np.abs(merged).sum())) // 2
+    return uniqueVars, merged, cancellation
 
 class AllBooleanUpperBound():
     """
@@ -25,10 +48,16 @@ class LazyInequality():
     of the operations.
     """
 
+    # opcodes for the postponed operations
+    SATURATE = 0
+    DIVIDE   = 1
+    MULTIPLY = 2
+
     def __init__(self, constraint):
         self.constraint = constraint
         self.operations = []
         self.degrees = []
+        self._applyFn = None
 
     @property
     def terms(self):
@@ -42,31 +71,102 @@ class LazyInequality():
         return Term(self.apply(value.coefficient), value.variable)
 
     def apply(self, value):
+        if self._applyFn is None:
+            self._applyFn = self._compile()
+        return self._applyFn(value)
+
+    def fusedOperations(self):
+        """
+        Collapse runs of equal operations: consecutive multiplications
+        combine into one factor and consecutive ceil-divisions by a and
+        b into one ceil-division by a * b (valid for positive divisors).
+        """
+        fused = []
         for op, i in self.operations:
-            if op == "s":
-                value = min(self.degrees[i], value)
-            elif op == "d":
-                value = (value + i - 1) // i
-            elif op == "*":
-                value *= i
-        return value
+            if fused and fused[-1][0] == op and op != LazyInequality.SATURATE:
+                fused[-1] = (op, fused[-1][1] * i)
+            else:
+                fused.append((op, i))
+        return fused
+
+    def _compile(self):
+        # build one closure for the whole operation chain so that the
+        # operations list is not reinterpreted for every value
+        fn = None
+        for op, i in self.fusedOperations():
+            prev = fn
+            if op == LazyInequality.SATURATE:
+                bound = self.degrees[i]
+                if prev is None:
+                    fn = lambda v, bound = bound: min(bound, v)
+                else:
+                    fn = lambda v, prev = prev, bound = bound: min(bound, prev(v))
+            elif op == LazyInequality.DIVIDE:
+                if prev is None:
+                    fn = lambda v, d = i: (v + d - 1) // d
+                else:
+                    fn = lambda v, prev = prev, d = i: (prev(v) + d - 1) // d
+            else:
+                if prev is None:
+                    fn = lambda v, f = i: v * f
+                else:
+                    fn = lambda v, prev = prev, f = i: prev(v) * f
+
+        if fn is None:
+            fn = lambda v: v
+        return fn
 
     def saturate(self):
         self.degrees.append(self.apply(self.constraint.degree))
-        self.operations.append(("s",len(self.degrees) - 1))
+        self.operations.append((LazyInequality.SATURATE, len(self.degrees) - 1))
+        self._applyFn = None
         return self
 
     def divide(self, d):
-        self.operations.append(("d",d))
+        self.operations.append((LazyInequality.DIVIDE, d))
+        self._applyFn = None
         return self
 
     def multiply(self, f):
-        self.operations.append(("*",f))
+        self.operations.append((LazyInequality.MULTIPLY, f))
+        self._applyFn = None
         return self
 
+    def materialize(self):
+        """
+        Turn into a real Inequality by replaying the fused operation
+        chain on a copy of the wrapped constraint. Each operation is
+        one vectorized pass over the coefficient array instead of an
+        apply call per term.
+        """
+        if isinstance(self.constraint, Inequality):
+            result = self.constraint.copy()
+        else:
+            # the wrapped constraint may itself still be lazy
+            result = Inequality(self.constraint.terms, self.constraint.degree)
+        for op, i in self.fusedOperations():
+            if op == LazyInequality.SATURATE:
+                result.saturate()
+            elif op == LazyInequality.DIVIDE:
+                result.divide(i)
+            else:
+                result.multiply(i)
+        # saturating on a negative degree leaves negative
+        # coefficients behind
+        result.normalize()
+        return result
+
     def addWithFactor(self, factor, other):
-        result = Inequality(self.terms, self.degree)
-        return result.addWithFactor(factor, other)
+        if factor == 1 and not self.operations \
+                and isinstance(self.constraint, Inequality) \
+                and isinstance(other, LazyInequality) \
+                and not other.operations \
+                and isinstance(other.constraint, Inequality) \
+                and len(other.constraint.coeffs) > len(self.constraint.coeffs):
+            # addition commutes, so grow a copy of the larger side by
+            # the smaller one instead of the other way around
+            return other.constraint.copy().addWithFactor(1, self.constraint)
+        return self.materialize().addWithFactor(factor, other)
 
     def contract(self):
         pass
@@ -82,6 +182,11 @@ class Inequality():
     greater 0, the sign of the literal is stored in the sign of the
     integer representing the variable, i.e. x ~ 2 then not x ~ -2.
 
+    The terms are stored in structure of arrays form: the parallel
+    arrays coeffs and vars hold the coefficient and the (signed)
+    literal of each term, so that the hot operations run as
+    vectorized numpy expressions instead of per Term objects.
+
     For integers 0 <= x <= d the not x is defined as d - x. Note that
     a change in the upperbound invalidates the stored constraint.
     """
@@ -111,106 +216,345 @@ class Inequality():
     def getCNFParser():
         return getCNFConstraintParser().bind(Inequality.fromParsy)
 
+    @staticmethod
+    def fromSum(factors, constraints):
+        """
+        Build sum(factor * constraint) over all pairs in one
+        vectorized merge instead of repeated addWithFactor calls.
+        Only valid for boolean upper bounds.
+        """
+        degree = 0
+        signedParts = list()
+        absVarParts = list()
+        for factor, constraint in zip(factors, constraints):
+            degree += factor * constraint.degree
+            signed = np.where(
+                constraint.vars < 0, -constraint.coeffs, constraint.coeffs)
+            signed *= factor
+            signedParts.append(signed)
+            absVarParts.append(constraint.absVars)
+
+        result = Inequality([], degree)
+        if not signedParts:
+            return result
+
+        uniqueVars, merged, cancellation = mergeSignedTerms(
+            np.concatenate(absVarParts), np.concatenate(signedParts))
+        result.degree -= cancellation
+
+        mask = merged != 0
+        merged = merged[mask]
+        uniqueVars = uniqueVars[mask]
+        result.coeffs = np.abs(merged)
+        result.vars = np.where(merged < 0, -uniqueVars, uniqueVars)
+        result.absVars = uniqueVars
+        result._isSorted = True
+        return result
+
     def __init__(self, terms = list(), degree = 0, variableUpperBounds = AllBooleanUpperBound()):
         self.degree = degree
-        self.terms = list(terms)
-        self.expanded = False
+        terms = list(terms)
+        try:
+            self.coeffs = np.fromiter(
+                (t.coefficient for t in terms), dtype = np.int64, count = len(terms))
+        except OverflowError:
+            # coefficients beyond int64 fall back to python ints
+            self.coeffs = np.array(
+                [t.coefficient for t in terms], dtype = object)
+        self.vars = np.fromiter(
+            (t.variable for t in terms), dtype = np.int64, count = len(terms))
+        # cached absolute values of vars; sign flips during
+        # normalization or merging leave it untouched
+        self.absVars = np.abs(self.vars)
         self.variableUpperBounds = variableUpperBounds
+        # with the boolean stub every lookup returns 1, so the hot
+        # paths can skip the __getitem__ call entirely
+        self._ubIsBool = isinstance(variableUpperBounds, AllBooleanUpperBound)
+        self._isSorted = bool(np.all(self.absVars[:-1] <= self.absVars[1:]))
         self.normalize()
         self._dict = None
 
     @property
-    def dict(self):
-        if self._dict is None:
-            self._dict = {abs(x.variable): x for x in self.terms}
-        return self._dict
+    def terms(self):
+        return [Term(int(c), int(v)) for c, v in zip(self.coeffs, self.vars)]
+
+    def copy(self):
+        result = Inequality.__new__(Inequality)
+        result.degree = self.degree
+        result.coeffs = np.copy(self.coeffs)
+        result.vars = np.copy(self.vars)
+        result.absVars = np.copy(self.absVars)
+        result.variableUpperBounds = self.variableUpperBounds
+        result._ubIsBool = self._ubIsBool
+        result._isSorted = self._isSorted
+        result._dict = dict(self._dict) if self._dict is not None else None
+        return result
+
+    def _promote(self):
+        """
+        Switch the coefficients from the int64 fast path to python
+        ints once they outgrow 64 bit. The conversion to int matters:
+        an object array of np.int64 scalars would still wrap around.
+        """
+        if self.coeffs.dtype != object:
+            self.coeffs = np.array(
+                [int(c) for c in self.coeffs], dtype = object)
 
     def contract(self):
         if self._dict is not None:
-            self.terms = [x for x in self.dict.values() if x.coefficient != 0]
-            self._dict = None
+            mask = self.coeffs != 0
+            if not mask.all():
+                self.coeffs = self.coeffs[mask]
+                self.vars = self.vars[mask]
+                self.absVars = self.absVars[mask]
+                # reindex in the same pass; invalidating would make a
+                # later merge rebuild the dict from scratch
+                self._dict = {int(v): i for i, v in enumerate(self.absVars)}
+
+        if not self._isSorted:
+            order = np.argsort(self.absVars, kind = "stable")
+            self.coeffs = self.coeffs[order]
+            self.vars = self.vars[order]
+            self.absVars = self.absVars[order]
+            if self._dict is not None:
+                self._dict = {int(v): i for i, v in enumerate(self.absVars)}
+            self._isSorted = True
 
     def normalize(self):
-        for term in self.terms:
-            if term.coefficient < 0:
-                term.variable = -term.variable
-                term.coefficient = abs(term.coefficient)
-                self.degree += self.variableUpperBounds[abs(term.variable)] * term.coefficient
+        mask = self.coeffs < 0
+        if mask.any():
+            negCoeffs = self.coeffs[mask]
+            if self._ubIsBool:
+                if self.coeffs.dtype != object \
+                        and negCoeffs.sum(dtype = np.float64) > -2**62:
+                    self.degree -= int(negCoeffs.sum())
+                else:
+                    # the int64 sum could wrap even though every
+                    # coefficient fits
+                    self.degree -= sum(int(c) for c in negCoeffs)
+            else:
+                negAbsVars = self.absVars[mask]
+                ubs = np.fromiter(
+                    (self.variableUpperBounds[int(v)] for v in negAbsVars),
+                    dtype = np.int64, count = len(negAbsVars))
+                if self.coeffs.dtype != object \
+                        and (negCoeffs.astype(np.float64) * ubs).sum() > -2**62:
+                    self.degree -= int((negCoeffs * ubs).sum())
+                else:
+                    self.degree -= sum(
+                        int(c) * int(u) for c, u in zip(negCoeffs, ubs))
+            self.vars[mask] = -self.vars[mask]
+            np.abs(self.coeffs, out = self.coeffs)
 
         # self.terms.sort(key = lambda x: abs(x.variable))
 
     # @profile
     def addWithFactor(self, factor, other):
-        self.degree += factor * other.degree
+        while isinstance(other, LazyInequality) and not other.operations:
+            # nothing is pending, unwrap to take the array based path
+            # below instead of going through the terms property
+            other = other.constraint
 
-        otherTerms = map(lambda x: Term(factor * x.coefficient, x.variable), other.terms)
+        self.degree += factor * other.degree
 
-        for other in otherTerms:
+        if isinstance(other, Inequality):
+            if len(other.coeffs) == 0:
+                # nothing to scale, and numpy would reject a factor
+                # beyond int64 even on an empty array
+                otherCoeffs = other.coeffs
+            elif other.coeffs.dtype != object \
+                    and (not -2**63 < factor < 2**63
+                         or abs(factor) * int(np.abs(other.coeffs).max()) >= 2**63):
+                otherCoeffs = np.array(
+                    [factor * int(c) for c in other.coeffs], dtype = object)
+            else:
+                otherCoeffs = factor * other.coeffs
+            otherVars = other.vars
+        else:
+            otherTerms = list(other.terms)
             try:
-                my = self.dict[abs(other.variable)]
-            except KeyError:
-                self.terms.append(Term(other.coefficient, other.variable))
-                self.dict[abs(other.variable)] = self.terms[-1]
+                otherCoeffs = np.fromiter(
+                    (factor * t.coefficient for t in otherTerms),
+                    dtype = np.int64, count = len(otherTerms))
+            except OverflowError:
+                otherCoeffs = np.array(
+                    [factor * t.coefficient for t in otherTerms], dtype = object)
+            otherVars = np.fromiter(
+                (t.variable for t in otherTerms),
+                dtype = np.int64, count = len(otherTerms))
+
+        # saturating on a negative degree can leave negative
+        # coefficients behind; the sign expansion below keeps their
+        # sign while copysign in the loop takes the absolute value,
+        # so such constraints have to take the loop
+        if len(otherVars) >= BULK_MERGE_THRESHOLD \
+                and isinstance(other, Inequality) \
+                and self._ubIsBool \
+                and self.coeffs.dtype != object \
+                and otherCoeffs.dtype != object \
+                and (self.coeffs >= 0).all() \
+                and (otherCoeffs >= 0).all() \
+                and self.coeffs.sum(dtype = np.float64) \
+                    + otherCoeffs.sum(dtype = np.float64) < 2**62:
+            mySigned = np.where(self.vars < 0, -self.coeffs, self.coeffs)
+            otherSigned = np.where(otherVars < 0, -otherCoeffs, otherCoeffs)
+            otherAbsVars = other.absVars if isinstance(other, Inequality) \
+                else np.abs(otherVars)
+            uniqueVars, merged, cancellation = mergeSignedTerms(
+                np.concatenate([self.absVars, otherAbsVars]),
+                np.concatenate([mySigned, otherSigned]))
+
+            self.degree -= cancellation
+            # cancelled terms are dropped right away, the mask is
+            # cheaper than a later contract pass
+            mask = merged != 0
+            merged = merged[mask]
+            uniqueVars = uniqueVars[mask]
+            self.coeffs = np.abs(merged)
+            self.vars = np.where(merged < 0, -uniqueVars, uniqueVars)
+            self.absVars = uniqueVars
+            # np.unique returns the variables in sorted order
+            self._isSorted = True
+            self._dict = None
+            return self
+
+        myDict = self._dict
+        if myDict is None:
+            myDict = self._dict = \
+                {int(v): i for i, v in enumerate(self.absVars)}
+        myCoeffs = self.coeffs
+        myVars = self.vars
+        upperBounds = self.variableUpperBounds
+        ubIsBool = self._ubIsBool
+        numTerms = len(myVars)
+
+        # entries for so far unseen variables are staged here and
+        # spliced into the arrays in one go at the end
+        newCoeffs = list()
+        newVars = list()
+        newAbsVars = list()
+
+        otherAbsVars = other.absVars if isinstance(other, Inequality) else None
+
+        for i in range(len(otherVars)):
+            variable = int(otherVars[i])
+            coefficient = int(otherCoeffs[i])
+            absVariable = int(otherAbsVars[i]) if otherAbsVars is not None \
+                else abs(variable)
+            my = myDict.get(absVariable)
+            if my is None:
+                myDict[absVariable] = numTerms + len(newVars)
+                newCoeffs.append(coefficient)
+                newVars.append(variable)
+                newAbsVars.append(absVariable)
             else:
-                if (abs(my.variable) == abs(other.variable)):
-                    a = copysign(my.coefficient, my.variable)
-                    b = copysign(other.coefficient, other.variable)
-                    newCoefficient = a + b
-                    newVariable = copysign(abs(my.variable), newCoefficient)
-                    newCoefficient = abs(newCoefficient)
-                    cancellation = max(0, max(my.coefficient, other.coefficient) - newCoefficient)
-                    self.degree -= cancellation * self.variableUpperBounds[abs(my.variable)]
-
-                    my.coefficient = newCoefficient
-                    my.variable = newVariable
+                a = copysign(int(myCoeffs[my]), int(myVars[my]))
+                b = copysign(coefficient, variable)
+                newCoefficient = a + b
+                newVariable = copysign(absVariable, newCoefficient)
+                newCoefficient = abs(newCoefficient)
+                cancellation = max(0, max(int(myCoeffs[my]), coefficient) - newCoefficient)
+                self.degree -= cancellation if ubIsBool \
+                    else cancellation * upperBounds[absVariable]
+
+                if newCoefficient >= 2**63 and myCoeffs.dtype != object:
+                    self._promote()
+                    myCoeffs = self.coeffs
+                myCoeffs[my] = newCoefficient
+                myVars[my] = newVariable
+
+        if newVars:
+            try:
+                staged = np.array(newCoeffs, dtype = myCoeffs.dtype)
+            except OverflowError:
+                self._promote()
+                myCoeffs = self.coeffs
+                staged = np.array(newCoeffs, dtype = object)
+            self.coeffs = np.concatenate([myCoeffs, staged])
+            self.vars = np.concatenate(
+                [myVars, np.array(newVars, dtype = np.int64)])
+            self.absVars = np.concatenate(
+                [self.absVars, np.array(newAbsVars, dtype = np.int64)])
+            self._isSorted = False
 
         return self
 
     def saturate(self):
-        self.dict
-        for term in self.terms:
-            term.coefficient = min(
-                term.coefficient,
-                self.degree)
+        if self.coeffs.dtype != object:
+            if -2**63 <= self.degree < 2**63:
+                _kernels.saturate(self.coeffs, self.degree)
+                return self
+            if self.degree >= 2**63:
+                # no coefficient can reach the degree
+                return self
+            self._promote()
+        self.coeffs = np.minimum(self.coeffs, self.degree)
         return self
 
     def divide(self, d):
-        for term in self.terms:
-            term.coefficient = (term.coefficient + d - 1) // d
+        fitsInt64 = d < 2**63
+        if self.coeffs.dtype != object and len(self.coeffs) \
+                and (not fitsInt64 or int(self.coeffs.max()) + d >= 2**63):
+            self._promote()
+        if self.coeffs.dtype != object:
+            if fitsInt64:
+                self.coeffs = _kernels.divide(self.coeffs, d)
+            # otherwise the array is empty and numpy would reject the
+            # divisor, only the degree changes
+        else:
+            self.coeffs = (self.coeffs + d - 1) // d
         self.degree = (self.degree + d - 1) // d
         return self
 
     def multiply(self, f):
-        for term in self.terms:
-            term.coefficient = term.coefficient * f
+        fitsInt64 = -2**63 < f < 2**63
+        if self.coeffs.dtype != object and len(self.coeffs) \
+                and (not fitsInt64
+                     or abs(f) * int(np.abs(self.coeffs).max()) >= 2**63):
+            self._promote()
+        if self.coeffs.dtype != object:
+            if fitsInt64:
+                self.coeffs = _kernels.multiply(self.coeffs, f)
+            # otherwise the array is empty and numpy would reject the
+            # factor, only the degree changes
+        else:
+            self.coeffs = self.coeffs * f
         self.degree = self.degree * f
         return self
 
     def isContradiction(self):
+        if self.coeffs.dtype != object \
+                and -2**62 < self.degree < 2**62 \
+                and np.abs(self.coeffs).sum(dtype = np.float64) < 2**62:
+            return _kernels.isContradiction(self.coeffs, self.degree)
+
         slack = -self.degree
-        for term in self.terms:
-            slack += term.coefficient
+        for coefficient in self.coeffs:
+            slack += int(coefficient)
         return slack < 0
 
 
     def __eq__(self, other):
-        # note that terms is assumed to be soreted
+        if not isinstance(other, Inequality):
+            other = Inequality(other.terms, other.degree)
+        # contract leaves the terms sorted by variable, so the
+        # arrays can be compared directly
         self.contract()
         other.contract()
-        key = lambda x: abs(x.variable)
         return self.degree == other.degree \
-            and sorted(self.terms, key = key) == sorted(other.terms, key = key)
+            and np.array_equal(self.vars, other.vars) \
+            and np.array_equal(self.coeffs, other.coeffs)
 
     def __str__(self):
-        def term2str(term):
-            if term.variable < 0:
-                return "%+i~x%i"%(term.coefficient, -term.variable)
+        def term2str(coefficient, variable):
+            if variable < 0:
+                return "%+i~x%i"%(coefficient, -variable)
             else:
-                return "%+ix%i"%(term.coefficient, term.variable)
+                return "%+ix%i"%(coefficient, variable)
 
         return " ".join(
-            map(term2str, self.terms)) + \
+            term2str(int(c), int(v)) for c, v in zip(self.coeffs, self.vars)) + \
             " >= %i" % self.degree
 
     def __repr__(self):
-        return str(self)
\ No newline at end of file
+        return str(self)
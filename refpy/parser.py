@@ -79,10 +79,29 @@ class RuleParser():
                 except parsy.ParseError as e:
                     raise ParseError(e, line = lineNum)
                 except ValueError as e:
-                    raise ParseError(e, line = lineNum)
+                    raise self.improveError(rule, line, lineNum, e)
 
         return result
 
+    def improveError(self, rule, line, lineNum, error):
+        """
+        The hand written parse method of a rule rejected the line; on
+        this cold path re-parse it with the rule's parsy grammar to
+        get a proper error message.
+        """
+        try:
+            rule.getParser().parse(line[1:].rstrip())
+        except parsy.ParseError as parseError:
+            # the id was not passed to the parser so we need to fix
+            # the position, but never past the end of the stream or
+            # formatting the error raises instead of printing it
+            parseError.index = min(
+                parseError.index + len(rule.Id), len(parseError.stream))
+            return ParseError(parseError, line = lineNum)
+        except Exception:
+            pass
+        return ParseError(error, line = lineNum)
+
 
 
 def getCNFConstraintParser():
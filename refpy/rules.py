@@ -1,6 +1,9 @@
 from refpy.constraints import Inequality
 from refpy.constraints import LazyInequality
 from refpy.constraints import Term
+from refpy.constraints import BULK_MERGE_THRESHOLD
+
+from array import array
 
 import parsy
 
@@ -11,42 +14,6 @@ def register_rule(rule):
     registered_rules.append(rule)
     return rule
 
-def fallback_on_error(parse):
-    """
-    Call the getParser() method of the class to get a
-    proper error message from the parser.
-    """
-    def f(*args, **kwargs):
-        try:
-            return parse(*args, **kwargs)
-        except ValueError as e:
-            try:
-                if len(args) >= 1:
-                    cls = args[0]
-                    args = args[1:]
-                else:
-                    cls = kwargs["cls"]
-                    del kwargs["cls"]
-                if len(args) >= 1:
-                    line = args[0]
-                    args = args[1:]
-                else:
-                    line = kwargs["line"]
-                    del kwargs["cls"]
-
-                cls.getParser(*args, **kwargs).parse(line)
-            except parsy.ParseError as parseError:
-                # the id is not supposed to be passed in line
-                # so we need to fix the position
-                parseError.index += len(cls.Id)
-                raise parseError
-            except AttributeError:
-                raise e
-            else:
-                raise e
-
-    return f
-
 class Rule():
     @staticmethod
     def getParser():
@@ -112,20 +79,23 @@ class EqualityCheckFailed(InvalidProof):
 @register_rule
 class ConstraintEquals(Rule):
     Id = "e"
+    _parser = None
 
-    @staticmethod
-    def getParser():
-        space = parsy.regex(" +").desc("space")
+    @classmethod
+    def getParser(cls):
+        if cls._parser is None:
+            space = parsy.regex(" +").desc("space")
 
-        opb = space.optional() >> parsy.regex(r"opb") \
-                >> space >> Inequality.getOPBParser(allowEq = False)
-        cnf = space.optional() >> parsy.regex(r"cnf") \
-                >> space >> Inequality.getCNFParser()
+            opb = space.optional() >> parsy.regex(r"opb") \
+                    >> space >> Inequality.getOPBParser(allowEq = False)
+            cnf = space.optional() >> parsy.regex(r"cnf") \
+                    >> space >> Inequality.getCNFParser()
 
-        constraintId = space.optional() >> parsy.regex(r"[+-]?[0-9]+ ") \
-            .map(int).desc("constraintId")
+            constraintId = space.optional() >> parsy.regex(r"[+-]?[0-9]+ ") \
+                .map(int).desc("constraintId")
 
-        return parsy.seq(constraintId, opb | cnf).combine(ConstraintEquals.fromParsy)
+            cls._parser = parsy.seq(constraintId, opb | cnf).combine(ConstraintEquals.fromParsy)
+        return cls._parser
 
     @staticmethod
     def fromParsy(constraintId, constraint):
@@ -158,16 +128,19 @@ class ContradictionCheckFailed(InvalidProof):
 @register_rule
 class IsContradiction(Rule):
     Id = "c"
+    _parser = None
 
-    @staticmethod
-    def getParser():
-        space = parsy.regex(" +").desc("space")
-        constraintId = space.optional() \
-            >> parsy.regex(r"[+-]?[0-9]+") \
-                .map(int).map(IsContradiction.fromParsy)
-        zero  = parsy.regex("0").desc("0 to end number sequence")
+    @classmethod
+    def getParser(cls):
+        if cls._parser is None:
+            space = parsy.regex(" +").desc("space")
+            constraintId = space.optional() \
+                >> parsy.regex(r"[+-]?[0-9]+") \
+                    .map(int).map(IsContradiction.fromParsy)
+            zero  = parsy.regex("0").desc("0 to end number sequence")
 
-        return constraintId << space << zero
+            cls._parser = constraintId << space << zero
+        return cls._parser
 
     @staticmethod
     def fromParsy(constraintId):
@@ -203,35 +176,81 @@ class IsContradiction(Rule):
 @register_rule
 class LinearCombination(Rule):
     Id = "a"
+    _parser = None
+    _rawParser = None
 
-    @staticmethod
-    def getParser(create = True):
-        space = parsy.regex(" +").desc("space")
-        factor = parsy.regex(r"[0-9]+").map(int).desc("factor")
-        constraintId = parsy.regex(r"[1-9][0-9]*").map(int).desc("constraintId")
-        zero  = parsy.regex("0").desc("0 to end number sequence")
+    @classmethod
+    def getParser(cls, create = True):
+        if cls._rawParser is None:
+            space = parsy.regex(" +").desc("space")
+            factor = parsy.regex(r"[0-9]+").map(int).desc("factor")
+            constraintId = parsy.regex(r"[1-9][0-9]*").map(int).desc("constraintId")
+            zero  = parsy.regex("0").desc("0 to end number sequence")
 
-        summand = parsy.seq(factor << space, constraintId << space).map(tuple)
-        parser = space.optional() >> summand.many() << zero
+            summand = parsy.seq(factor << space, constraintId << space).map(tuple)
+            cls._rawParser = space.optional() >> summand.many() << zero
 
         if create:
-            return parser.map(LinearCombination.fromParsy)
+            if cls._parser is None:
+                cls._parser = cls._rawParser.map(LinearCombination.fromParsy)
+            return cls._parser
         else:
-            return parser
+            return cls._rawParser
 
     @staticmethod
     def fromParsy(sequence):
         factors, antecedentIds = zip(*sequence)
         return LinearCombination(factors, antecedentIds)
 
+    @classmethod
+    def parse(cls, line):
+        values = line.split()
+        if not values or values[-1] != "0":
+            raise ValueError()
+        values.pop()
+        if len(values) % 2 != 0:
+            raise ValueError()
+
+        numbers = list(map(int, values))
+        factors = tuple(numbers[0::2])
+        antecedentIds = tuple(numbers[1::2])
+        if not factors \
+                or any(f < 0 for f in factors) \
+                or any(i <= 0 for i in antecedentIds):
+            raise ValueError()
+
+        return cls(factors, antecedentIds)
+
     def __init__(self, factors, antecedentIds):
         assert len(factors) == len(antecedentIds)
         self.antecedentIds = antecedentIds
         self.factors = factors
 
     def compute(self, antecedents):
-        result = Inequality()
+        # merge everything in one vectorized pass when the combination
+        # is large and provably free of int64 overflow
+        numTerms = 0
+        total = 0.
+        fuse = True
+        for factor, constraint in zip(self.factors, antecedents):
+            # fromSum is only valid for boolean upper bounds and for
+            # normalized, i.e. non negative, coefficients; the factor
+            # is bounded before it gets anywhere near int64 or float
+            # arithmetic
+            if factor >= 2**62 \
+                    or not isinstance(constraint, Inequality) \
+                    or constraint.coeffs.dtype == object \
+                    or not constraint._ubIsBool \
+                    or not (constraint.coeffs >= 0).all():
+                fuse = False
+                break
+            numTerms += len(constraint.coeffs)
+            total += factor * constraint.coeffs.sum(dtype = float)
+
+        if fuse and numTerms >= BULK_MERGE_THRESHOLD and total < 2**62:
+            return [Inequality.fromSum(self.factors, antecedents)]
 
+        result = Inequality()
         for factor, constraint in zip(self.factors, antecedents):
             result.addWithFactor(factor, constraint)
 
@@ -244,8 +263,6 @@ class LinearCombination(Rule):
         return self.antecedentIds
 
     def __eq__(self, other):
-        print(self.antecedentIds)
-        print(other.antecedentIds)
         return self.antecedentIds == other.antecedentIds
 
     def isGoal(self):
@@ -254,22 +271,46 @@ class LinearCombination(Rule):
 @register_rule
 class Division(LinearCombination):
     Id = "d"
+    _parser = None
 
-    @staticmethod
-    def getParser():
-        space = parsy.regex(" +").desc("space")
-        divisor = parsy.regex(r"[1-9][0-9]*").map(int).desc("positive divisor")
+    @classmethod
+    def getParser(cls):
+        if cls._parser is None:
+            space = parsy.regex(" +").desc("space")
+            divisor = parsy.regex(r"[1-9][0-9]*").map(int).desc("positive divisor")
 
-        return parsy.seq(
-                space.optional() >> divisor,
-                LinearCombination.getParser(create = False)
-            ).combine(Division.fromParsy)
+            cls._parser = parsy.seq(
+                    space.optional() >> divisor,
+                    LinearCombination.getParser(create = False)
+                ).combine(Division.fromParsy)
+        return cls._parser
 
     @staticmethod
     def fromParsy(divisor, sequence):
         factors, antecedentIds = zip(*sequence)
         return Division(divisor, factors, antecedentIds)
 
+    @classmethod
+    def parse(cls, line):
+        values = line.split()
+        if len(values) < 2 or values[-1] != "0":
+            raise ValueError()
+        values.pop()
+        if len(values) % 2 != 1:
+            raise ValueError()
+
+        numbers = list(map(int, values))
+        divisor = numbers[0]
+        factors = tuple(numbers[1::2])
+        antecedentIds = tuple(numbers[2::2])
+        if divisor <= 0 \
+                or not factors \
+                or any(f < 0 for f in factors) \
+                or any(i <= 0 for i in antecedentIds):
+            raise ValueError()
+
+        return cls(divisor, factors, antecedentIds)
+
     def __init__(self, divisor, factors, antecedentIds):
         assert len(factors) == len(antecedentIds)
         super().__init__(factors, antecedentIds)
@@ -286,10 +327,13 @@ class Division(LinearCombination):
 @register_rule
 class Saturation(LinearCombination):
     Id = "s"
+    _parser = None
 
-    @staticmethod
-    def getParser():
-        return LinearCombination.getParser(create = False).map(Saturation.fromParsy)
+    @classmethod
+    def getParser(cls):
+        if cls._parser is None:
+            cls._parser = LinearCombination.getParser(create = False).map(Saturation.fromParsy)
+        return cls._parser
 
     @staticmethod
     def fromParsy(sequence):
@@ -304,25 +348,32 @@ class Saturation(LinearCombination):
 @register_rule
 class LoadLitteralAxioms(Rule):
     Id = "l"
+    _parser = None
 
-    @staticmethod
-    def getParser():
-        return parsy.regex(r" *[1-9][0-9]*") \
-                .map(int)\
-                .map(LoadLitteralAxioms.fromParsy)\
-                .desc("number of literals") << parsy.regex(r" 0")
+    @classmethod
+    def getParser(cls):
+        if cls._parser is None:
+            cls._parser = parsy.regex(r" *[1-9][0-9]*") \
+                    .map(int)\
+                    .map(LoadLitteralAxioms.fromParsy)\
+                    .desc("number of literals") << parsy.regex(r" 0")
+        return cls._parser
 
     @staticmethod
     def fromParsy(numLiterals):
         return LoadLitteralAxioms(numLiterals)
 
-    # @classmethod
-    # def parse(cls, line):
-    #     values = line.strip().split()
-    #     if len(values) != 2:
-    #         raise ValueError()
+    @classmethod
+    def parse(cls, line):
+        values = line.split()
+        if len(values) != 2 or values[1] != "0":
+            raise ValueError()
+
+        numLiterals = int(values[0])
+        if numLiterals <= 0:
+            raise ValueError()
 
-    #     return cls(int(values[0]))
+        return cls(numLiterals)
 
     def __init__(self, numLiterals):
         self.numLiterals = numLiterals
@@ -344,9 +395,13 @@ class LoadLitteralAxioms(Rule):
 @register_rule
 class ReversePolishNotation(Rule):
     Id = "p"
+    _parser = None
+
+    @classmethod
+    def getParser(cls):
+        if cls._parser is not None:
+            return cls._parser
 
-    @staticmethod
-    def getParser():
         stackSize = 0
         def check(thing):
             nonlocal stackSize
@@ -377,12 +432,12 @@ class ReversePolishNotation(Rule):
         number = parsy.regex(r"[0-9]+").map(int).desc("number")
         operator = parsy.regex(r"[+*ds]").desc("operator +,*,d,s")
 
-        return (space.optional() >> (number | operator).bind(check)).many().bind(finalCheck) \
+        cls._parser = (space.optional() >> (number | operator).bind(check)).many().bind(finalCheck) \
             << space << parsy.regex(r"0").desc("0 to terminate sequence").optional()
+        return cls._parser
 
 
     @classmethod
-    @fallback_on_error
     def parse(cls, line):
         def f(word):
             if word in ["+", "*", "d", "s"]:
@@ -396,21 +451,12 @@ class ReversePolishNotation(Rule):
         return cls(sequence)
 
 
-    class AntecedentIterator():
-        def __init__(self, instructions):
-            self.instructions = iter(instructions)
-
-        def __iter__(self):
-            return self
-
-        def __next__(self):
-            while (True):
-                current = next(self.instructions)
-                if isinstance(current, int):
-                    return current
-                if current in ["*", "d"]:
-                    # consume one more, remember that we swaped the right operand and operator
-                    next(self.instructions)
+    # opcodes of the translated instruction stream
+    PUSH     = 0
+    ADD      = 1
+    MULTIPLY = 2
+    DIVIDE   = 3
+    SATURATE = 4
 
     def __init__(self, instructions):
         for i, x in enumerate(instructions):
@@ -422,34 +468,60 @@ class ReversePolishNotation(Rule):
                 instructions[i] = instructions[i - 1]
                 instructions[i - 1] = x
 
-        self.instructions = instructions
+        # translate once into a flat opcode, operand stream so that
+        # compute dispatches on integers instead of comparing strings
+        code = list()
+        it = iter(instructions)
+        for ins in it:
+            if isinstance(ins, int):
+                code.append(ReversePolishNotation.PUSH)
+                code.append(ins)
+            elif ins == "+":
+                code.append(ReversePolishNotation.ADD)
+                code.append(0)
+            elif ins == "*":
+                code.append(ReversePolishNotation.MULTIPLY)
+                code.append(next(it))
+            elif ins == "d":
+                code.append(ReversePolishNotation.DIVIDE)
+                code.append(next(it))
+            elif ins == "s":
+                code.append(ReversePolishNotation.SATURATE)
+                code.append(0)
+
+        try:
+            self.code = array("q", code)
+        except OverflowError:
+            # an operand beyond int64, keep the plain list
+            self.code = code
 
     def compute(self, antecedents):
         stack = list()
         antecedentIt = iter(antecedents)
 
-        it = iter(self.instructions)
-        ins = next(it, None)
-        while ins is not None:
-            if isinstance(ins, int):
+        push     = ReversePolishNotation.PUSH
+        add      = ReversePolishNotation.ADD
+        multiply = ReversePolishNotation.MULTIPLY
+        divide   = ReversePolishNotation.DIVIDE
+
+        code = self.code
+        pc = 0
+        end = len(code)
+        while pc < end:
+            op = code[pc]
+            if op == push:
                 stack.append(LazyInequality(next(antecedentIt)))
-            elif ins == "+":
+            elif op == add:
                 second = stack.pop()
                 first  = stack.pop()
                 stack.append(first.addWithFactor(1, second))
-            elif ins == "*":
-                constraint = stack.pop()
-                factor = next(it)
-                stack.append(constraint.multiply(factor))
-            elif ins == "d":
-                constraint = stack.pop()
-                divisor = next(it)
-                stack.append(constraint.divide(divisor))
-            elif ins == "s":
-                constraint = stack.pop()
-                stack.append(constraint.saturate())
-
-            ins = next(it, None)
+            elif op == multiply:
+                stack.append(stack.pop().multiply(code[pc + 1]))
+            elif op == divide:
+                stack.append(stack.pop().divide(code[pc + 1]))
+            else:
+                stack.append(stack.pop().saturate())
+            pc += 2
 
         assert len(stack) == 1
         stack[0].contract()
@@ -459,7 +531,9 @@ class ReversePolishNotation(Rule):
         return 1
 
     def antecedentIDs(self):
-        return ReversePolishNotation.AntecedentIterator(self.instructions)
+        code = self.code
+        return (code[pc + 1] for pc in range(0, len(code), 2)
+            if code[pc] == ReversePolishNotation.PUSH)
 
 class LoadFormula(Rule):
     Id = "f"
@@ -517,6 +591,5 @@ class LoadFormulaWrapper():
         self.formula = None
         return result
 
-    @fallback_on_error
     def parse(self, line):
         return LoadFormula.parse(line, self.formula)
\ No newline at end of file
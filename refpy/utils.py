@@ -1,6 +1,9 @@
 import argparse
+import hashlib
 import logging
+import os
 import parsy
+import pickle
 
 from refpy import InvalidProof
 from refpy import ParseError
@@ -12,12 +15,42 @@ from refpy.parser import RuleParser
 from refpy.exceptions import ParseError
 from time import perf_counter
 
-def run(formulaFile, rulesFile, settings = None):
-    rules = list(registered_rules)
+# bump whenever the pickled representation of rules changes
+CACHE_FORMAT_VERSION = 2
 
-    start_parse = perf_counter()
+def getCacheDir():
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME",
+            os.path.join(os.path.expanduser("~"), ".cache")),
+        "refpy")
+
+def parseProof(formulaFile, rulesFile):
+    """
+    Parse formula and proof into the list of rules to verify. The
+    result is cached on disk keyed by the content of both files, so
+    repeated runs over the same input skip parsing entirely.
+    """
+    formulaText = formulaFile.read()
+    proofText = rulesFile.read()
+
+    # the length prefix keeps the formula / proof boundary out of the
+    # hash, otherwise moving text between the two files could collide
+    formulaBytes = formulaText.encode()
+    key = hashlib.sha256()
+    key.update(("refpy-%i %i\n" % (CACHE_FORMAT_VERSION, len(formulaBytes))).encode())
+    key.update(formulaBytes)
+    key.update(proofText.encode())
+    cacheFile = os.path.join(getCacheDir(), key.hexdigest() + ".pkl")
+
+    try:
+        with open(cacheFile, "rb") as file:
+            return pickle.load(file)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        pass
+
+    rules = list(registered_rules)
     try:
-        formula = getOPBParser().parse(formulaFile.read())
+        formula = getOPBParser().parse(formulaText)
         numVars, numConstraints = formula[0]
         constraints = formula[1]
     except parsy.ParseError as e:
@@ -26,11 +59,24 @@ def run(formulaFile, rulesFile, settings = None):
     rules.append(LoadFormulaWrapper(constraints))
 
     try:
-        rules = RuleParser().parse(rules, rulesFile)
+        rules = RuleParser().parse(rules, proofText.splitlines(keepends = True))
     except ParseError as e:
         e.fileName = rulesFile.name
         raise e
 
+    # caching is best effort, a read only cache dir is no reason to fail
+    try:
+        os.makedirs(getCacheDir(), exist_ok = True)
+        with open(cacheFile, "wb") as file:
+            pickle.dump(rules, file)
+    except (OSError, pickle.PicklingError):
+        pass
+
+    return rules
+
+def run(formulaFile, rulesFile, settings = None):
+    start_parse = perf_counter()
+    rules = parseProof(formulaFile, rulesFile)
     logging.info("Parsing Time: %.2f" % (perf_counter() - start_parse))
     verify = Verifier(settings)
     verify(rules)
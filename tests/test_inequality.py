@@ -265,6 +265,58 @@ class TestInequality():
         r = geq([(2,-1), (1,-2)], 0)
         assert r == a
 
+    def test_multiply_overflow(self):
+        a = geq([(2**40, 1)], 1)
+        a.multiply(2**40)
+        b = geq([(2**80, 1)], 2**40)
+        assert a == b
+
+    def test_add_overflow(self):
+        a = geq([(2**62, 1)], 1)
+        b = geq([(2**62, 1)], 1)
+
+        a.addWithFactor(4, b)
+
+        r = geq([(5 * 2**62, 1)], 5)
+        assert r == a
+
+    def test_divide_overflow(self):
+        a = geq([(2**70, 1)], 2**70)
+        a.divide(2**10)
+        b = geq([(2**60, 1)], 2**60)
+        assert a == b
+
+    def test_scale_empty_overflow(self):
+        a = geq([], 5)
+        a.multiply(10**400)
+        a.divide(10**400)
+        b = geq([], 5)
+        assert a == b
+
+    def test_normalize_overflow(self):
+        a = geq([(-10**18, v) for v in range(1, 151)], 0)
+        assert a.degree == 150 * 10**18
+
+    def test_saturate_overflow(self):
+        a = geq([(2**70, 1), (1, 2)], 2)
+        a.saturate()
+        b = geq([(2, 1), (1, 2)], 2)
+        assert a == b
+
+    def test_add_negative_coeff_consistent(self):
+        # saturating on a negative degree leaves a negative
+        # coefficient; the result must not depend on whether the
+        # merge is vectorized
+        def build(filler):
+            a = geq([(5, 1)], -3).saturate()
+            b = geq([(2, -1)] + [(1, v) for v in range(2, 2 + filler)], 1)
+            return a.addWithFactor(1, b)
+
+        small = build(4)
+        large = build(200)
+        assert small.degree == large.degree
+        assert small.terms[0] == large.terms[0]
+
     def test_add_canceling_6(self):
         a = geq([(1, 1), (1, 2), (1, 3)], 1)
         b = geq([(1, 1), (-1, 2)], 1)
@@ -1,5 +1,8 @@
+import os
+import sys
 import unittest
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 from env import refpy
@@ -58,5 +61,24 @@ for file in parsing_failure:
 
 
 
+def runSingleTest(name):
+    # runs in a worker process, so only the test name travels over
+    # the process boundary
+    result = unittest.TestResult()
+    TestIntegration(name).run(result)
+    return name, [message for _, message in result.failures + result.errors]
+
 if __name__=="__main__":
-    unittest.main()
\ No newline at end of file
+    # the proofs are independent of each other so they are verified
+    # across all cores instead of going through unittest.main()
+    names = unittest.TestLoader().getTestCaseNames(TestIntegration)
+    numFailed = 0
+    with ProcessPoolExecutor(os.cpu_count()) as pool:
+        for name, messages in pool.map(runSingleTest, names):
+            if messages:
+                numFailed += 1
+                print("FAIL: %s"%(name))
+                for message in messages:
+                    print(message)
+    print("ran %i tests, %i failed"%(len(names), numFailed))
+    sys.exit(numFailed != 0)
\ No newline at end of file